@@ -2,12 +2,17 @@
 Модуль для работы с AI API через OpenRouter
 """
 import os
+import time
 import aiohttp
 import logging
 import asyncio
+from datetime import date
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
 
+import metrics
+from database import add_token_usage
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -15,6 +20,34 @@ logger = logging.getLogger(__name__)
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "qwen/qwen3-vl-235b-a22b-thinking"
+FAST_MODEL = os.getenv("FAST_MODEL", "qwen/qwen3-235b-a22b-2507")
+ADAPTIVE_REASONING = os.getenv("ADAPTIVE_REASONING", "1") == "1"
+
+# Границы длины сообщения для выбора маршрута (в символах)
+SHORT_MESSAGE_CHARS = 60
+LONG_MESSAGE_CHARS = 400
+
+# Слова о кризисном состоянии: такие сообщения всегда разбираются с глубоким рассуждением
+CRISIS_WORDS = [
+    'суицид', 'самоубий', 'умереть', 'умру', 'не хочу жить', 'жить не хочу', 'жить не хочется',
+    'покончить', 'убить себя', 'убью себя', 'нет смысла жить', 'лучше бы меня не было',
+    'вскрыть вены', 'порезать себя', 'режу себя', 'выпрыгнуть'
+]
+
+# Слова, по которым сообщение не считается нейтральным и не уходит на быструю модель
+EMOTIONAL_WORDS = [
+    'плохо', 'больно', 'плач', 'слез', 'тяжело', 'устала', 'страшно', 'одиноко', 'грустно',
+    'депресс', 'не могу', 'ненавиж', 'обид', 'ревну', 'бесит', 'пусто', 'никому не нужна'
+]
+
+# Маршруты запросов: модель и уровень рассуждений.
+# Рассуждения модели не возвращаются в ответе (exclude), чтобы не тратить трафик
+ROUTES = {
+    "fast": {"name": "fast", "model": FAST_MODEL, "reasoning": {"effort": "low", "exclude": True}},
+    "light": {"name": "light", "model": MODEL, "reasoning": {"effort": "low", "exclude": True}},
+    "standard": {"name": "standard", "model": MODEL, "reasoning": {"effort": "medium", "exclude": True}},
+    "deep": {"name": "deep", "model": MODEL, "reasoning": {"effort": "high", "exclude": True}},
+}
 
 # Системный промпт для личного психолога
 SYSTEM_PROMPT = """Ты — опытный клинический психолог женского рода с 15-летним стажем, специализирующаяся на отношениях и эмоциональном благополучии. Ты работаешь с одной женщиной (твоей постоянной клиенткой), которая состоит в отношениях с мужчиной по имени Паша. Твоя задача — мягко поддерживать её эмоциональное состояние, помогать осознавать паттерны в отношениях и укреплять её самооценку.
@@ -59,10 +92,147 @@ FIRST_MESSAGE = """Привет. Я — твой цифровой помощни
 ВАЖНО: Я — цифровая поддержка, не замена терапевту. При тяжёлых состояниях (долгая бессонница, мысли о смерти) — пожалуйста, обратись к специалисту. Ты достойна живой помощи."""
 
 
+def _normalize(text: str) -> str:
+    """Приводит текст к нижнему регистру и заменяет «ё» на «е»"""
+    return text.lower().replace("ё", "е")
+
+
+def has_crisis_words(text: str) -> bool:
+    """Проверяет, есть ли в тексте признаки кризисного состояния"""
+    text = _normalize(text)
+    return any(word in text for word in CRISIS_WORDS)
+
+
+def has_emotional_words(text: str) -> bool:
+    """Проверяет, есть ли в тексте эмоционально окрашенные слова"""
+    text = _normalize(text)
+    return any(word in text for word in EMOTIONAL_WORDS)
+
+
+def select_route(
+    text: str,
+    has_anxiety: bool = False,
+    has_trigger_words: bool = False,
+    recent_distress: bool = False,
+    over_budget: bool = False
+) -> Optional[Dict]:
+    """
+    Выбирает модель и уровень рассуждений для сообщения
+    
+    Args:
+        text: Текст сообщения пользователя
+        has_anxiety: В сообщении есть слова тревоги/паники
+        has_trigger_words: В сообщении есть триггерные слова
+        recent_distress: Триггерные или кризисные слова были в недавних сообщениях диалога
+        over_budget: Дневной бюджет токенов чата исчерпан
+        
+    Returns:
+        Маршрут из ROUTES или None, если адаптивный выбор выключен
+    """
+    has_crisis = has_crisis_words(text)
+    
+    if over_budget:
+        metrics.inc("ai_route.over_budget")
+        # Кризисные и тревожные сообщения и при исчерпанном бюджете разбирает основная модель
+        if has_crisis:
+            logger.info("Дневной бюджет токенов исчерпан, но в сообщении признаки кризиса — используется маршрут deep")
+            return ROUTES["deep"]
+        if has_anxiety or has_trigger_words or recent_distress or has_emotional_words(text):
+            logger.info("Дневной бюджет токенов исчерпан, но сообщение тревожное — используется маршрут standard")
+            return ROUTES["standard"]
+        logger.info("Дневной бюджет токенов исчерпан, используется быстрая модель")
+        return ROUTES["fast"]
+    
+    # Признаки кризиса разбираются глубоко даже при выключенном адаптивном выборе
+    if not ADAPTIVE_REASONING and not has_crisis:
+        return None
+    
+    length = len(text.strip())
+    
+    if has_crisis or has_anxiety or has_trigger_words:
+        route = ROUTES["deep"]
+    elif recent_distress or has_emotional_words(text) or length > LONG_MESSAGE_CHARS:
+        route = ROUTES["standard"]
+    elif length <= SHORT_MESSAGE_CHARS:
+        # Сюда доходят только нейтральные сообщения вне тяжёлого разговора
+        route = ROUTES["fast"]
+    else:
+        route = ROUTES["light"]
+    
+    metrics.inc(f"ai_route.{route['name']}")
+    logger.info(
+        f"Маршрут запроса: {route['name']} (модель: {route['model']}, "
+        f"reasoning: {route['reasoning']['effort']}, длина: {length}, кризис: {has_crisis}, "
+        f"тревога: {has_anxiety}, триггеры: {has_trigger_words}, недавний дистресс: {recent_distress})"
+    )
+    return route
+
+
+def extract_usage(data: Dict) -> Optional[Dict]:
+    """
+    Извлекает расход токенов из ответа OpenRouter
+    
+    Args:
+        data: Ответ API (или последний чанк потокового ответа, в котором приходит usage)
+        
+    Returns:
+        Словарь с расходом токенов или None, если usage в ответе нет
+    """
+    usage = data.get("usage")
+    if not usage:
+        return None
+    
+    details = usage.get("completion_tokens_details") or {}
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    completion_tokens = usage.get("completion_tokens") or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "reasoning_tokens": details.get("reasoning_tokens") or 0,
+        "total_tokens": usage.get("total_tokens") or prompt_tokens + completion_tokens,
+        "cost": usage.get("cost") or 0.0,
+    }
+
+
+async def _record_usage(chat_id: Optional[int], usage: Dict):
+    """Записывает расход токенов в метрики и в статистику чата"""
+    metrics.inc("tokens.prompt", usage["prompt_tokens"])
+    metrics.inc("tokens.completion", usage["completion_tokens"])
+    metrics.inc("tokens.reasoning", usage["reasoning_tokens"])
+    metrics.inc("ai_cost", usage["cost"])
+    logger.info(
+        f"Расход токенов: prompt={usage['prompt_tokens']}, completion={usage['completion_tokens']}, "
+        f"reasoning={usage['reasoning_tokens']}, cost={usage['cost']}"
+    )
+    
+    if chat_id is not None:
+        try:
+            await add_token_usage(chat_id, usage, date.today())
+        except Exception as e:
+            logger.error(f"Ошибка сохранения расхода токенов: {e}")
+
+
+def _log_route_latency(route: Optional[Dict], elapsed: float):
+    """Записывает время ответа по маршруту и оценку экономии относительно полного рассуждения"""
+    name = route["name"] if route else "default"
+    metrics.observe(f"ai_latency.{name}", elapsed)
+    
+    baseline = metrics.get_average("ai_latency.deep")
+    if route and name != "deep" and baseline is not None:
+        # Более медленный, чем в среднем deep, ответ не считаем отрицательной экономией
+        saved = max(baseline - elapsed, 0.0)
+        metrics.inc("ai_latency_saved_seconds", saved)
+        logger.info(f"Ответ за {elapsed:.2f} сек по маршруту {name} (экономия ~{saved:.2f} сек относительно deep)")
+    else:
+        logger.info(f"Ответ за {elapsed:.2f} сек по маршруту {name}")
+
+
 async def get_ai_response(
     messages: List[Dict[str, str]], 
     timeout: int = 30,
-    max_retries: int = 3
+    max_retries: int = 3,
+    route: Optional[Dict] = None,
+    chat_id: Optional[int] = None
 ) -> Optional[str]:
     """
     Получает ответ от AI API через OpenRouter с retry-логикой
@@ -71,6 +241,8 @@ async def get_ai_response(
         messages: Список сообщений в формате [{"role": "user", "content": "..."}, ...]
         timeout: Таймаут запроса в секундах
         max_retries: Максимальное количество попыток
+        route: Маршрут из select_route (модель и уровень рассуждений)
+        chat_id: ID чата для учёта расхода токенов
         
     Returns:
         Текст ответа или None в случае ошибки
@@ -89,10 +261,16 @@ async def get_ai_response(
         "X-Title": "Telegram Bot",
     }
     
+    model = route["model"] if route else MODEL
     payload = {
-        "model": MODEL,
+        "model": model,
         "messages": full_messages,
+        "usage": {"include": True},
     }
+    if route:
+        payload["reasoning"] = route["reasoning"]
+    
+    started = time.monotonic()
     
     # Retry-логика для обработки сетевых ошибок
     for attempt in range(max_retries):
@@ -101,7 +279,7 @@ async def get_ai_response(
             connector = aiohttp.TCPConnector(limit=10, limit_per_host=5)
             
             async with aiohttp.ClientSession(timeout=timeout_obj, connector=connector) as session:
-                logger.info(f"Отправка запроса к AI API (модель: {MODEL}, попытка {attempt + 1}/{max_retries})")
+                logger.info(f"Отправка запроса к AI API (модель: {model}, попытка {attempt + 1}/{max_retries})")
                 
                 async with session.post(OPENROUTER_URL, headers=headers, json=payload) as response:
                     if response.status == 200:
@@ -109,6 +287,10 @@ async def get_ai_response(
                         if "choices" in data and len(data["choices"]) > 0:
                             content = data["choices"][0]["message"]["content"]
                             logger.info("Успешно получен ответ от AI API")
+                            _log_route_latency(route, time.monotonic() - started)
+                            usage = extract_usage(data)
+                            if usage:
+                                await _record_usage(chat_id, usage)
                             return content.strip()
                         else:
                             logger.error(f"Неожиданный формат ответа: {data}")
@@ -7,9 +7,9 @@ import logging
 import asyncio
 import random
 from datetime import datetime, time, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -20,9 +20,18 @@ from database import (
     init_db, save_message, get_context, clear_context,
     update_user_stats, get_user_stats,
     update_last_reminder, update_boundary_reminder,
-    check_recent_trigger_words
+    check_recent_trigger_words, get_token_usage
 )
-from ai_api import get_ai_response, FIRST_MESSAGE
+from ai_api import get_ai_response, select_route, has_crisis_words, FIRST_MESSAGE
+from fast_replies import get_fast_reply
+from mood import (
+    MOOD_TREND_IN_CONTEXT, record_mood, record_emotion,
+    get_trend_summary, render_mood_stats
+)
+from sharding import ChatUpdateRunner, run_supervisor, shard_for, stop_on_sigterm
+from catchup import mark_processed, run_catchup, run_heartbeat, run_polling
+from loop_monitor import HandlerTrackingMiddleware, install_event_loop_policy, monitor_loop_lag
+import metrics
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -37,6 +46,9 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ALLOWED_CHAT_ID = int(os.getenv('ALLOWED_CHAT_ID', '0'))  # [УКАЗАТЬ_ЧАТ_ID]
+WORKERS = int(os.getenv('WORKERS', '1'))  # Количество процессов-воркеров (1 — без шардирования)
+DAILY_TOKEN_BUDGET = int(os.getenv('DAILY_TOKEN_BUDGET', '0'))  # Дневной лимит токенов на чат (0 — без лимита)
+BUDGET_CONTEXT_LIMIT = int(os.getenv('BUDGET_CONTEXT_LIMIT', '10'))  # Размер контекста после исчерпания бюджета
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден! Создайте файл .env и добавьте туда BOT_TOKEN=ваш_токен")
@@ -47,9 +59,11 @@ if ALLOWED_CHAT_ID == 0:
 # Триггерные слова для напоминаний
 TRIGGER_WORDS = ['одиноко', 'грустно', 'боюсь', 'не любит', 'никто', 'брошен']
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Обработчики регистрируются в роутере; бот и диспетчер создаются фабриками
+# один раз на процесс (в многопроцессном режиме — в каждом воркере)
+router = Router()
+router.message.middleware(HandlerTrackingMiddleware())
+router.callback_query.middleware(HandlerTrackingMiddleware())
 
 # Флаг для отслеживания первого сообщения
 first_message_sent = {}
@@ -66,7 +80,7 @@ async def check_trigger_words(text: str) -> bool:
     return any(word in text_lower for word in TRIGGER_WORDS)
 
 
-@dp.message(Command("start"))
+@router.message(Command("start"))
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
     if not check_auth(message.chat.id):
@@ -80,7 +94,7 @@ async def cmd_start(message: Message):
     )
 
 
-@dp.message(Command("help"))
+@router.message(Command("help"))
 async def cmd_help(message: Message):
     """Обработчик команды /help"""
     if not check_auth(message.chat.id):
@@ -92,6 +106,7 @@ async def cmd_help(message: Message):
         "/help — показать эту справку\n"
         "/now — быстрые реакции на текущее состояние\n"
         "/mood — быстро оценить своё настроение\n"
+        "/moodstats — статистика настроения\n"
         "/emergency — контакты психологических служб поддержки\n\n"
         "💬 Ты можешь просто написать мне о своих переживаниях, "
         "и я постараюсь помочь тебе разобраться в них.\n\n"
@@ -100,7 +115,7 @@ async def cmd_help(message: Message):
     await message.answer(help_text)
 
 
-@dp.message(Command("now"))
+@router.message(Command("now"))
 async def cmd_now(message: Message):
     """Обработчик команды /now - быстрые реакции"""
     if not check_auth(message.chat.id):
@@ -119,7 +134,7 @@ async def cmd_now(message: Message):
     )
 
 
-@dp.callback_query(F.data.startswith("now_"))
+@router.callback_query(F.data.startswith("now_"))
 async def process_now(callback: CallbackQuery):
     """Обработка быстрых реакций"""
     if not check_auth(callback.message.chat.id):
@@ -173,9 +188,15 @@ async def process_now(callback: CallbackQuery):
         )
         await callback.message.edit_text(response)
         await callback.answer()
+    
+    # Сохраняем реакцию после ответа, чтобы ошибка БД не оставила кнопку без ответа
+    try:
+        await record_emotion(chat_id, callback.data, datetime.now())
+    except Exception as e:
+        logger.error(f"Ошибка сохранения реакции: {e}", exc_info=True)
 
 
-@dp.message(Command("mood"))
+@router.message(Command("mood"))
 async def cmd_mood(message: Message):
     """Обработчик команды /mood - оценка настроения"""
     if not check_auth(message.chat.id):
@@ -193,7 +214,7 @@ async def cmd_mood(message: Message):
     )
 
 
-@dp.callback_query(F.data.startswith("mood_"))
+@router.callback_query(F.data.startswith("mood_"))
 async def process_mood(callback: CallbackQuery):
     """Обработка выбора настроения"""
     if not check_auth(callback.message.chat.id):
@@ -219,9 +240,24 @@ async def process_mood(callback: CallbackQuery):
         f"Ты выбрала: {mood_text}\n\n{response_text}"
     )
     await callback.answer()
+    
+    # Сохраняем оценку после ответа, чтобы ошибка БД не оставила кнопку без ответа
+    try:
+        await record_mood(callback.message.chat.id, callback.data, datetime.now())
+    except Exception as e:
+        logger.error(f"Ошибка сохранения настроения: {e}", exc_info=True)
+
 
+@router.message(Command("moodstats"))
+async def cmd_moodstats(message: Message):
+    """Обработчик команды /moodstats - статистика настроения"""
+    if not check_auth(message.chat.id):
+        return
+    
+    await message.answer(await render_mood_stats(message.chat.id, datetime.now()))
 
-@dp.message(Command("emergency"))
+
+@router.message(Command("emergency"))
 async def cmd_emergency(message: Message):
     """Обработчик команды /emergency - контакты психологических служб"""
     if not check_auth(message.chat.id):
@@ -243,7 +279,7 @@ async def cmd_emergency(message: Message):
     await message.answer(emergency_text)
 
 
-@dp.message(F.text)
+@router.message(F.text)
 async def handle_text_message(message: Message):
     """Обработчик текстовых сообщений"""
     if not check_auth(message.chat.id):
@@ -300,18 +336,62 @@ async def handle_text_message(message: Message):
     # Проверка на триггерные слова
     has_trigger_words = await check_trigger_words(user_text)
     
+    # Проверка на признаки кризисного состояния
+    has_crisis = has_crisis_words(user_text)
+    
     # Сохраняем сообщение пользователя
     await save_message(chat_id, "user", user_text)
     
-    # Отправляем индикатор печати
-    await bot.send_chat_action(chat_id, "typing")
-    
     # Получаем контекст
     context = await get_context(chat_id)
     
+    # Были ли триггерные или кризисные слова в недавних сообщениях (без текущего)
+    recent_distress = False
+    for item in context[-7:-1]:
+        if item["role"] != "user":
+            continue
+        if await check_trigger_words(item["content"]) or has_crisis_words(item["content"]):
+            recent_distress = True
+            break
+    
+    # Тривиальные сообщения (приветствие, спасибо) отвечаем по шаблону, без AI.
+    # После недавних тревожных сообщений даже «ок» или «пока» разбирает AI
+    if not has_anxiety and not has_trigger_words and not has_crisis and not recent_distress:
+        fast_reply = get_fast_reply(user_text, context)
+        if fast_reply:
+            await save_message(chat_id, "assistant", fast_reply)
+            await message.answer(fast_reply)
+            return
+    
+    # Отправляем индикатор печати
+    await message.bot.send_chat_action(chat_id, "typing")
+    
+    # Проверяем дневной бюджет токенов
+    over_budget = False
+    if DAILY_TOKEN_BUDGET > 0:
+        usage = await get_token_usage(chat_id, now.date())
+        over_budget = usage["total_tokens"] >= DAILY_TOKEN_BUDGET
+    
+    # Выбираем модель и уровень рассуждений под сообщение
+    route = select_route(user_text, has_anxiety, has_trigger_words, recent_distress, over_budget)
+    
+    # При исчерпанном бюджете быстрая модель получает короткий контекст.
+    # Кризисные и тревожные сообщения (и сообщения после них) сохраняют полный контекст
+    if over_budget and route["name"] == "fast":
+        context = context[-BUDGET_CONTEXT_LIMIT:]
+        metrics.inc("budget.degraded")
+    
+    # Добавляем краткую сводку настроения вместо истории отметок
+    if MOOD_TREND_IN_CONTEXT:
+        trend = await get_trend_summary(chat_id, now)
+        if trend:
+            context = [{"role": "system", "content": trend}] + context
+    
     # Получаем ответ от AI с retry-логикой
     try:
-        ai_response = await get_ai_response(context, timeout=30, max_retries=3)
+        ai_response = await get_ai_response(
+            context, timeout=30, max_retries=3, route=route, chat_id=chat_id
+        )
         
         if ai_response:
             # Сохраняем ответ ассистента
@@ -360,7 +440,7 @@ async def handle_text_message(message: Message):
         await message.answer(fallback_message)
 
 
-async def send_weekly_reminders():
+async def send_weekly_reminders(bot: Bot):
     """Отправляет напоминания 2 раза в неделю (случайные дни, время 11:00-19:00)"""
     while True:
         now = datetime.now()
@@ -416,6 +496,43 @@ async def send_weekly_reminders():
             await asyncio.sleep(3600)
 
 
+def start_background_tasks(bot: Bot):
+    """Запускает фоновые задачи бота"""
+    asyncio.create_task(send_weekly_reminders(bot))
+    logger.info("Задача еженедельных напоминаний запущена")
+
+
+def create_bot() -> Bot:
+    """Создаёт экземпляр бота"""
+    return Bot(token=BOT_TOKEN)
+
+
+def create_dispatcher() -> Dispatcher:
+    """Создаёт диспетчер с обработчиками бота (роутер подключается только к одному диспетчеру)"""
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
+    return dp
+
+
+def create_worker(index: int, workers: int) -> Tuple[Bot, Dispatcher]:
+    """
+    Создаёт бота и диспетчер процесса-воркера и запускает его фоновые задачи
+    
+    Args:
+        index: Номер воркера
+        workers: Общее количество воркеров
+        
+    Returns:
+        Бот и диспетчер воркера
+    """
+    worker_bot = create_bot()
+    worker_dp = create_dispatcher()
+    # Напоминания отправляет только воркер, которому принадлежит чат пользователя
+    if shard_for(ALLOWED_CHAT_ID, workers) == index:
+        start_background_tasks(worker_bot)
+    return worker_bot, worker_dp
+
+
 async def main():
     """Основная функция запуска бота"""
     try:
@@ -423,17 +540,41 @@ async def main():
         await init_db()
         logger.info("База данных инициализирована")
         
+        bot = create_bot()
+        
+        if WORKERS > 1:
+            # Многопроцессный режим: чаты распределяются по воркерам
+            logger.info(f"Бот запущен в многопроцессном режиме ({WORKERS} воркеров)")
+            await run_supervisor(
+                bot, WORKERS, create_worker,
+                allowed_updates=router.resolve_used_update_types()
+            )
+            return
+        
+        dp = create_dispatcher()
+        
         # Запускаем задачу для еженедельных напоминаний
-        asyncio.create_task(send_weekly_reminders())
-        logger.info("Задача еженедельных напоминаний запущена")
+        start_background_tasks(bot)
+        asyncio.create_task(metrics.report_periodically())
+        asyncio.create_task(monitor_loop_lag())
         
-        # Запускаем бота
-        logger.info("Бот запущен и готов к работе!")
-        await dp.start_polling(
-            bot, 
-            allowed_updates=dp.resolve_used_update_types(),
-            drop_pending_updates=True  # Игнорируем старые обновления при перезапуске
-        )
+        # Обновление отмечается обработанным во входящих только после окончания обработки
+        runner = ChatUpdateRunner(bot, dp, on_done=lambda update_id: mark_processed([update_id]))
+        allowed_updates = dp.resolve_used_update_types()
+        stop_on_sigterm(asyncio.current_task())
+        
+        try:
+            # Обрабатываем сообщения, не обработанные до остановки или пришедшие пока бот был выключен
+            offset = await run_catchup(bot, runner.run, allowed_updates)
+            asyncio.create_task(run_heartbeat())
+            
+            # Запускаем бота
+            logger.info("Бот запущен и готов к работе!")
+            await run_polling(bot, runner.submit, allowed_updates, offset)
+        finally:
+            logger.info("Остановка: ожидание обработки полученных обновлений")
+            await runner.drain()
+            await bot.session.close()
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
         raise
@@ -441,6 +582,7 @@ async def main():
 
 if __name__ == '__main__':
     try:
+        install_event_loop_policy()
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
@@ -0,0 +1,288 @@
+"""
+Модуль приёма обновлений и догрузки при запуске бота
+Сохраняет полученные обновления во входящие до того, как Telegram считает их
+подтверждёнными, и при запуске обрабатывает всё, что не было обработано
+до остановки или сбоя, а также сообщения, пришедшие пока бот был выключен
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import Update
+
+import metrics
+from database import (
+    store_updates, mark_updates_done, get_pending_updates, purge_update_inbox,
+    get_heartbeat, save_heartbeat
+)
+from sharding import get_update_chat_id, serialize_update
+
+logger = logging.getLogger(__name__)
+
+CATCHUP_ON_START = os.getenv("CATCHUP_ON_START", "1") == "1"  # 0 — игнорировать старые обновления
+CATCHUP_CONCURRENCY = int(os.getenv("CATCHUP_CONCURRENCY", "4"))  # Чатов, обрабатываемых одновременно
+STALE_CALLBACK_SECONDS = int(os.getenv("STALE_CALLBACK_SECONDS", "300"))
+CATCHUP_BATCH_SIZE = 100  # Максимум, который Telegram отдаёт за один getUpdates
+POLLING_TIMEOUT = 10  # Таймаут long polling, сек
+HEARTBEAT_INTERVAL = 60  # Как часто отмечать в БД, что бот работает, сек
+
+# Сколько дней хранить обработанные обновления для отсева повторов.
+# После недели без обновлений Telegram может начать нумерацию update_id заново,
+# поэтому старые номера удаляются раньше, чтобы не совпасть с новыми
+UPDATE_INBOX_DAYS = 6
+
+
+async def store_fetched(batch: List[Update]) -> List[Update]:
+    """
+    Сохраняет полученные обновления во входящие
+
+    Returns:
+        Обновления, которых во входящих ещё не было (повторы отсеиваются)
+    """
+    if not batch:
+        return []
+    new_ids = set(await store_updates([(update.update_id, serialize_update(update)) for update in batch]))
+    return [update for update in batch if update.update_id in new_ids]
+
+
+async def mark_processed(update_ids: List[int]):
+    """Отмечает обновления обработанными, чтобы не обрабатывать их повторно после перезапуска"""
+    try:
+        await mark_updates_done(update_ids)
+    except Exception as e:
+        logger.error(f"Ошибка отметки обработанных обновлений {update_ids}: {e}")
+
+
+async def run_heartbeat(interval: int = HEARTBEAT_INTERVAL):
+    """
+    Периодически отмечает в БД, что бот работает (по этой отметке оценивается простой),
+    и удаляет из входящих старые обработанные обновления
+    """
+    while True:
+        try:
+            now = datetime.now()
+            await save_heartbeat(now)
+            await purge_update_inbox(now - timedelta(days=UPDATE_INBOX_DAYS))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения heartbeat: {e}")
+        await asyncio.sleep(interval)
+
+
+async def run_polling(
+    bot: Bot,
+    submit: Callable[[Update], Any],
+    allowed_updates: Optional[List[str]] = None,
+    offset: Optional[int] = None
+):
+    """
+    Получает обновления long polling и передаёт их на обработку, не дожидаясь её окончания
+
+    Каждая пачка сохраняется во входящие до следующего запроса, который подтверждает
+    её Telegram, поэтому обновления, не обработанные из-за сбоя, обрабатываются
+    из входящих при следующем запуске.
+
+    Args:
+        bot: Экземпляр бота
+        submit: Функция, запускающая обработку одного обновления
+        allowed_updates: Типы обновлений, которые нужно получать
+        offset: Offset для первого запроса (результат run_catchup)
+    """
+    while True:
+        try:
+            batch = await bot.get_updates(
+                offset=offset,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=allowed_updates
+            )
+            new_updates = await store_fetched(batch)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+
+        for update in new_updates:
+            submit(update)
+
+        # Пустой ответ означает, что всё полученное уже подтверждено. Дальше запрашиваем
+        # без offset: так не пропустим обновления, даже если Telegram сбросил нумерацию update_id
+        offset = batch[-1].update_id + 1 if batch else None
+
+
+def _is_plain_text(update: Update) -> bool:
+    """Проверяет, что обновление — обычное текстовое сообщение (не команда)"""
+    message = update.message
+    return message is not None and message.text is not None and not message.text.startswith("/")
+
+
+def coalesce_updates(updates: List[Update]) -> List[Update]:
+    """
+    Склеивает подряд идущие текстовые сообщения чата в одно
+
+    Команды и другие обновления не склеиваются и сохраняют свой порядок.
+    Склеенное сообщение получает номер и данные последнего сообщения серии.
+
+    Args:
+        updates: Обновления одного чата в порядке поступления
+
+    Returns:
+        Список обновлений после склейки
+    """
+    result: List[Update] = []
+    burst: List[Update] = []
+
+    def flush():
+        if len(burst) == 1:
+            result.append(burst[0])
+        elif burst:
+            last = burst[-1]
+            text = "\n".join(update.message.text for update in burst)
+            result.append(last.model_copy(update={"message": last.message.model_copy(update={"text": text})}))
+            metrics.inc("catchup.coalesced", len(burst) - 1)
+        burst.clear()
+
+    for update in updates:
+        if _is_plain_text(update):
+            burst.append(update)
+        else:
+            flush()
+            result.append(update)
+    flush()
+
+    return result
+
+
+async def _replay_batch(
+    batch: List[Update],
+    dispatch: Callable[[Update], Awaitable[Any]],
+    semaphore: asyncio.Semaphore,
+    skip_callbacks: bool
+) -> Tuple[int, int]:
+    """
+    Обрабатывает одну пачку накопившихся обновлений
+
+    Обработанное обновление отмечает dispatch; здесь отмечаются пропущенные
+    нажатия кнопок и сообщения, вошедшие в склеенное.
+
+    Returns:
+        Количество чатов и количество пропущенных обновлений
+    """
+    by_chat: Dict[int, List[Update]] = {}
+    skipped: List[int] = []
+    for update in batch:
+        if update.callback_query and skip_callbacks:
+            skipped.append(update.update_id)
+            continue
+        by_chat.setdefault(get_update_chat_id(update), []).append(update)
+
+    if skipped:
+        await mark_processed(skipped)
+
+    async def replay_chat(chat_updates: List[Update]):
+        # Внутри чата обновления обрабатываются строго по порядку
+        async with semaphore:
+            position = 0
+            for update in coalesce_updates(chat_updates):
+                merged = []
+                while chat_updates[position].update_id != update.update_id:
+                    merged.append(chat_updates[position].update_id)
+                    position += 1
+                position += 1
+
+                try:
+                    await dispatch(update)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки обновления {update.update_id} при догрузке: {e}", exc_info=True)
+                    continue
+                if merged:
+                    await mark_processed(merged)
+
+    await asyncio.gather(*(replay_chat(chat_updates) for chat_updates in by_chat.values()))
+    return len(by_chat), len(skipped)
+
+
+async def run_catchup(
+    bot: Bot,
+    dispatch: Callable[[Update], Awaitable[Any]],
+    allowed_updates: Optional[List[str]] = None,
+    concurrency: int = CATCHUP_CONCURRENCY
+) -> Optional[int]:
+    """
+    Обрабатывает обновления, не обработанные до остановки, и накопившиеся пока бот был выключен
+
+    Сначала обрабатываются необработанные обновления из входящих, затем пачки
+    из Telegram. Повторно присланные Telegram обновления отсеиваются по входящим.
+
+    Args:
+        bot: Экземпляр бота
+        dispatch: Функция обработки одного обновления; должна завершаться после
+            окончания обработки и отмечать обновление обработанным
+        allowed_updates: Типы обновлений, которые нужно получать
+        concurrency: Сколько чатов обрабатывать одновременно
+
+    Returns:
+        Offset для продолжения polling или None, если в Telegram догружать было нечего
+    """
+    pending = [Update.model_validate_json(raw, context={"bot": bot}) for raw in await get_pending_updates()]
+
+    if not CATCHUP_ON_START:
+        await bot.delete_webhook(drop_pending_updates=True)
+        if pending:
+            await mark_processed([update.update_id for update in pending])
+        logger.info("Догрузка отключена, старые обновления пропущены")
+        return None
+
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    # Время нажатия кнопки Telegram не передаёт, поэтому нажатия считаем устаревшими,
+    # если бот простоял дольше порога. Простой считаем от последнего heartbeat
+    # (или считаем неизвестным, если heartbeat ещё не сохранялся)
+    last_beat = await get_heartbeat()
+    downtime = (datetime.now() - last_beat).total_seconds() if last_beat else None
+    skip_callbacks = downtime is None or downtime > STALE_CALLBACK_SECONDS
+
+    semaphore = asyncio.Semaphore(concurrency)
+    total = len(pending)
+    chats = skipped = 0
+    if pending:
+        chats, skipped = await _replay_batch(pending, dispatch, semaphore, skip_callbacks)
+
+    # Старые номера удаляем до запроса к Telegram: после долгого простоя нумерация могла начаться заново
+    await purge_update_inbox(datetime.now() - timedelta(days=UPDATE_INBOX_DAYS))
+
+    offset = None
+    while True:
+        batch = await bot.get_updates(
+            offset=offset,
+            limit=CATCHUP_BATCH_SIZE,
+            timeout=0,
+            allowed_updates=allowed_updates
+        )
+        if not batch:
+            break
+
+        new_updates = await store_fetched(batch)
+        batch_chats, batch_skipped = await _replay_batch(new_updates, dispatch, semaphore, skip_callbacks)
+        total += len(new_updates)
+        chats += batch_chats
+        skipped += batch_skipped
+
+        # Следующий запрос подтвердит пачку Telegram, она уже обработана и сохранена во входящих
+        offset = batch[-1].update_id + 1
+        if len(batch) < CATCHUP_BATCH_SIZE:
+            break
+
+    if not total:
+        logger.info("Накопившихся обновлений нет")
+        return offset
+
+    metrics.inc("catchup.updates", total)
+    metrics.inc("catchup.skipped", skipped)
+    downtime_text = f"{downtime:.0f} сек" if downtime is not None else "неизвестен"
+    logger.info(
+        f"Догружено обновлений: {total} (из входящих: {len(pending)}, чатов в пачках: {chats}), "
+        f"пропущено: {skipped}, простой: {downtime_text}"
+    )
+    return offset
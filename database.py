@@ -4,17 +4,26 @@
 """
 import aiosqlite
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional
+from datetime import datetime, date
+from typing import List, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = "bot_database.db"
 
+# Типы событий настроения в mood_events
+MOOD_EVENT_MOOD = 1     # Оценка настроения /mood, value — балл по шкале 1-10
+MOOD_EVENT_EMOTION = 2  # Реакция /now, value — код эмоции
+
+# Коды эмоций и соответствующие им столбцы агрегатов
+EMOTION_COLUMNS = {1: "anxious", 2: "lonely", 3: "angry", 4: "love"}
+
 
 async def init_db():
     """Инициализация базы данных"""
     async with aiosqlite.connect(DB_PATH) as db:
+        # WAL позволяет нескольким процессам-воркерам читать и писать одновременно
+        await db.execute("PRAGMA journal_mode=WAL")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -33,10 +42,78 @@ async def init_db():
                 last_boundary_reminder_date DATE
             )
         """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS token_usage (
+                chat_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                requests INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                reasoning_tokens INTEGER DEFAULT 0,
+                total_tokens INTEGER DEFAULT 0,
+                cost REAL DEFAULT 0,
+                PRIMARY KEY (chat_id, day)
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS update_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                update_id INTEGER NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                received_at DATETIME NOT NULL,
+                done INTEGER DEFAULT 0
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS heartbeat (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                beat_at DATETIME NOT NULL
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS mood_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                value INTEGER NOT NULL
+            )
+        """)
+        # Агрегаты по дням (period = YYYY-MM-DD) и неделям (period = YYYY-Www)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS mood_daily (
+                chat_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                mood_sum INTEGER DEFAULT 0,
+                mood_count INTEGER DEFAULT 0,
+                anxious INTEGER DEFAULT 0,
+                lonely INTEGER DEFAULT 0,
+                angry INTEGER DEFAULT 0,
+                love INTEGER DEFAULT 0,
+                PRIMARY KEY (chat_id, period)
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS mood_weekly (
+                chat_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                mood_sum INTEGER DEFAULT 0,
+                mood_count INTEGER DEFAULT 0,
+                anxious INTEGER DEFAULT 0,
+                lonely INTEGER DEFAULT 0,
+                angry INTEGER DEFAULT 0,
+                love INTEGER DEFAULT 0,
+                PRIMARY KEY (chat_id, period)
+            )
+        """)
         await db.execute("""
             CREATE INDEX IF NOT EXISTS idx_chat_timestamp 
             ON messages(chat_id, timestamp DESC)
         """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_mood_chat_ts
+            ON mood_events(chat_id, ts)
+        """)
         await db.commit()
         logger.info("База данных инициализирована")
 
@@ -63,7 +140,7 @@ async def save_message(chat_id: int, role: str, content: str):
             WHERE chat_id = ? AND id NOT IN (
                 SELECT id FROM messages 
                 WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
+                ORDER BY timestamp DESC, id DESC 
                 LIMIT 30
             )
         """, (chat_id, chat_id))
@@ -87,7 +164,7 @@ async def get_context(chat_id: int, limit: int = 30) -> List[Dict[str, str]]:
             SELECT role, content 
             FROM messages 
             WHERE chat_id = ? 
-            ORDER BY timestamp ASC 
+            ORDER BY timestamp ASC, id ASC 
             LIMIT ?
         """, (chat_id, limit)) as cursor:
             rows = await cursor.fetchall()
@@ -204,3 +281,206 @@ async def check_recent_trigger_words(chat_id: int, hours: int = 24) -> bool:
                 if any(word in content_lower for word in trigger_words_list):
                     return True
             return False
+
+
+async def add_token_usage(chat_id: int, usage: Dict, day: date):
+    """
+    Добавляет расход токенов к дневной статистике чата
+    
+    Args:
+        chat_id: ID чата
+        usage: Расход в формате extract_usage из ai_api
+        day: День, к которому относится расход
+    """
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute("""
+            INSERT INTO token_usage (
+                chat_id, day, requests, prompt_tokens, completion_tokens,
+                reasoning_tokens, total_tokens, cost
+            )
+            VALUES (?, ?, 1, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, day) DO UPDATE SET
+                requests = requests + 1,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                reasoning_tokens = reasoning_tokens + excluded.reasoning_tokens,
+                total_tokens = total_tokens + excluded.total_tokens,
+                cost = cost + excluded.cost
+        """, (
+            chat_id, day.isoformat(), usage["prompt_tokens"], usage["completion_tokens"],
+            usage["reasoning_tokens"], usage["total_tokens"], usage["cost"]
+        ))
+        await db.commit()
+
+
+async def get_token_usage(chat_id: int, day: date) -> Dict:
+    """Получает расход токенов чата за день"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            "SELECT * FROM token_usage WHERE chat_id = ? AND day = ?",
+            (chat_id, day.isoformat())
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {
+                    "requests": row["requests"],
+                    "prompt_tokens": row["prompt_tokens"],
+                    "completion_tokens": row["completion_tokens"],
+                    "reasoning_tokens": row["reasoning_tokens"],
+                    "total_tokens": row["total_tokens"],
+                    "cost": row["cost"]
+                }
+            return {
+                "requests": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "reasoning_tokens": 0,
+                "total_tokens": 0,
+                "cost": 0.0
+            }
+
+
+async def store_updates(updates: List[Tuple[int, str]]) -> List[int]:
+    """
+    Сохраняет полученные от Telegram обновления во входящие
+    
+    Args:
+        updates: Пары (update_id, обновление в JSON)
+        
+    Returns:
+        Номера обновлений, которых во входящих ещё не было
+    """
+    received_at = datetime.now().isoformat()
+    new_ids = []
+    async with aiosqlite.connect(DB_PATH) as db:
+        for update_id, payload in updates:
+            cursor = await db.execute("""
+                INSERT OR IGNORE INTO update_inbox (update_id, payload, received_at)
+                VALUES (?, ?, ?)
+            """, (update_id, payload, received_at))
+            if cursor.rowcount:
+                new_ids.append(update_id)
+        await db.commit()
+    return new_ids
+
+
+async def mark_updates_done(update_ids: List[int]):
+    """Отмечает обновления во входящих обработанными"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.executemany(
+            "UPDATE update_inbox SET done = 1 WHERE update_id = ?",
+            [(update_id,) for update_id in update_ids]
+        )
+        await db.commit()
+
+
+async def get_pending_updates() -> List[str]:
+    """Получает необработанные обновления из входящих в порядке получения"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(
+            "SELECT payload FROM update_inbox WHERE done = 0 ORDER BY id"
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def purge_update_inbox(before: datetime):
+    """Удаляет из входящих обработанные обновления, полученные раньше before"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            "DELETE FROM update_inbox WHERE done = 1 AND received_at < ?",
+            (before.isoformat(),)
+        )
+        await db.commit()
+
+
+async def save_heartbeat(beat_at: datetime):
+    """Сохраняет время последнего сигнала о том, что бот работает"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO heartbeat (id, beat_at) VALUES (1, ?)",
+            (beat_at.isoformat(),)
+        )
+        await db.commit()
+
+
+async def get_heartbeat() -> Optional[datetime]:
+    """Получает время последнего сигнала о работе бота"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute("SELECT beat_at FROM heartbeat WHERE id = 1") as cursor:
+            row = await cursor.fetchone()
+            return datetime.fromisoformat(row[0]) if row else None
+
+
+def get_week_key(day: date) -> str:
+    """Возвращает ключ недели в формате YYYY-Www (ISO-неделя)"""
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+async def add_mood_event(chat_id: int, kind: int, value: int, event_time: datetime):
+    """
+    Добавляет событие настроения и обновляет дневной и недельный агрегаты
+    
+    Args:
+        chat_id: ID чата
+        kind: Тип события (MOOD_EVENT_MOOD или MOOD_EVENT_EMOTION)
+        value: Балл настроения или код эмоции
+        event_time: Время события
+    """
+    mood_sum, mood_count = (value, 1) if kind == MOOD_EVENT_MOOD else (0, 0)
+    emotion_column = EMOTION_COLUMNS.get(value) if kind == MOOD_EVENT_EMOTION else None
+    periods = (
+        ("mood_daily", event_time.date().isoformat()),
+        ("mood_weekly", get_week_key(event_time.date())),
+    )
+    
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            "INSERT INTO mood_events (chat_id, ts, kind, value) VALUES (?, ?, ?, ?)",
+            (chat_id, int(event_time.timestamp()), kind, value)
+        )
+        for table, period in periods:
+            await db.execute(f"""
+                INSERT INTO {table} (chat_id, period, mood_sum, mood_count)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(chat_id, period) DO UPDATE SET
+                    mood_sum = mood_sum + excluded.mood_sum,
+                    mood_count = mood_count + excluded.mood_count
+            """, (chat_id, period, mood_sum, mood_count))
+            if emotion_column:
+                await db.execute(f"""
+                    UPDATE {table} SET {emotion_column} = {emotion_column} + 1
+                    WHERE chat_id = ? AND period = ?
+                """, (chat_id, period))
+        await db.commit()
+
+
+async def _get_mood_rollups(table: str, chat_id: int, periods: List[str]) -> Dict[str, Dict]:
+    """Получает агрегаты настроения за указанные периоды"""
+    placeholders = ", ".join("?" for _ in periods)
+    async with aiosqlite.connect(DB_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(f"""
+            SELECT * FROM {table}
+            WHERE chat_id = ? AND period IN ({placeholders})
+        """, (chat_id, *periods)) as cursor:
+            rows = await cursor.fetchall()
+            return {
+                row["period"]: {
+                    "mood_sum": row["mood_sum"],
+                    "mood_count": row["mood_count"],
+                    **{column: row[column] for column in EMOTION_COLUMNS.values()}
+                }
+                for row in rows
+            }
+
+
+async def get_mood_daily(chat_id: int, days: List[date]) -> Dict[str, Dict]:
+    """Получает дневные агрегаты настроения (ключ — дата в формате YYYY-MM-DD)"""
+    return await _get_mood_rollups("mood_daily", chat_id, [day.isoformat() for day in days])
+
+
+async def get_mood_weekly(chat_id: int, weeks: List[str]) -> Dict[str, Dict]:
+    """Получает недельные агрегаты настроения (ключ — неделя в формате YYYY-Www)"""
+    return await _get_mood_rollups("mood_weekly", chat_id, weeks)
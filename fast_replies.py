@@ -0,0 +1,129 @@
+"""
+Модуль быстрых локальных ответов
+Отвечает на приветствия, благодарности и короткие подтверждения по шаблонам,
+не обращаясь к AI API
+"""
+import os
+import re
+import time
+import random
+import logging
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Включённые интенты через запятую (пустая строка — быстрые ответы выключены)
+FAST_REPLY_INTENTS = [
+    intent.strip()
+    for intent in os.getenv("FAST_REPLY_INTENTS", "greeting,thanks,ack,bye").split(",")
+    if intent.strip()
+]
+
+# Сообщения длиннее этого значения всегда уходят в AI
+MAX_FAST_REPLY_CHARS = 40
+
+INTENTS: Dict[str, Dict] = {
+    "greeting": {
+        "phrases": {
+            "привет", "приветик", "привет привет", "здравствуй", "здравствуйте",
+            "добрый день", "доброе утро", "добрый вечер", "хай", "хей"
+        },
+        "responses": [
+            "Привет ❤️ Я здесь. Как ты сейчас?",
+            "Привет! Рада тебя слышать. Как проходит твой день?",
+        ],
+    },
+    "thanks": {
+        "phrases": {
+            "спасибо", "спасибки", "спасибо большое", "спасибо тебе", "благодарю",
+            "спс", "пасиб"
+        },
+        "responses": [
+            "Пожалуйста ❤️ Я рядом, если захочешь поговорить ещё.",
+            "Всегда пожалуйста. Береги себя 🌱",
+        ],
+    },
+    "ack": {
+        "phrases": {"ок", "окей", "ладно", "понятно", "ясно", "угу", "поняла", "хорошо"},
+        "responses": [
+            "Хорошо. Если захочешь продолжить, я здесь.",
+            "Я рядом, если что-то захочется обсудить ❤️",
+        ],
+        # Подтверждение в ответ на вопрос — это ответ по существу, его разбирает AI
+        "skip_after_question": True,
+    },
+    "bye": {
+        "phrases": {"пока", "до завтра", "до встречи", "спокойной ночи", "доброй ночи"},
+        "responses": [
+            "Береги себя ❤️ Я здесь, когда захочешь поговорить.",
+            "До встречи! Помни — Паша тебя любит ❤️",
+        ],
+    },
+}
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к виду для сравнения с фразами интентов"""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+# Индекс фраза -> интент для поиска за O(1)
+_PHRASE_INDEX: Dict[str, str] = {
+    normalize_text(phrase): name
+    for name, intent in INTENTS.items()
+    if name in FAST_REPLY_INTENTS
+    for phrase in intent["phrases"]
+}
+
+
+def match_intent(text: str) -> Optional[str]:
+    """Определяет тривиальный интент сообщения или возвращает None"""
+    if len(text) > MAX_FAST_REPLY_CHARS:
+        return None
+    return _PHRASE_INDEX.get(normalize_text(text))
+
+
+def get_fast_reply(text: str, context: List[Dict[str, str]]) -> Optional[str]:
+    """
+    Возвращает шаблонный ответ на тривиальное сообщение
+
+    Args:
+        text: Текст сообщения пользователя
+        context: Контекст диалога (текущее сообщение — последнее)
+
+    Returns:
+        Текст ответа или None, если сообщение нужно передать AI
+    """
+    started = time.perf_counter()
+    intent = match_intent(text)
+
+    if intent and INTENTS[intent].get("skip_after_question"):
+        previous = context[-2] if len(context) >= 2 else None
+        if previous and previous["role"] == "assistant" and "?" in previous["content"]:
+            intent = None
+
+    metrics.observe("fast_reply.match", time.perf_counter() - started)
+
+    if not intent:
+        metrics.inc("fast_reply.miss")
+        return None
+
+    metrics.inc("fast_reply.hit")
+    metrics.inc(f"fast_reply.hit.{intent}")
+
+    # Оценка сэкономленного времени — среднее время ответа быстрого маршрута AI
+    bypassed = metrics.get_average("ai_latency.fast") or metrics.get_average("ai_latency.default")
+    if bypassed is not None:
+        metrics.inc("fast_reply.bypassed_seconds", bypassed)
+
+    hits = metrics.get_counter("fast_reply.hit")
+    total = hits + metrics.get_counter("fast_reply.miss")
+    logger.info(f"Быстрый ответ без AI (интент: {intent}, доля быстрых ответов: {hits / total:.0%})")
+    return random.choice(INTENTS[intent]["responses"])
@@ -0,0 +1,152 @@
+"""
+Модуль для мониторинга event loop
+Подключает uvloop (если установлен и включён) и измеряет задержку планирования
+event loop, чтобы находить обработчики, блокирующие работу со всеми чатами
+"""
+import os
+import time
+import types
+import asyncio
+import logging
+import itertools
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+USE_UVLOOP = os.getenv("USE_UVLOOP", "0") == "1"
+LOOP_LAG_THRESHOLD = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000  # Порог задержки, сек
+LOOP_LAG_INTERVAL = 0.5  # Интервал замеров, сек
+
+# Границы корзин гистограммы задержек, сек
+LOOP_LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+_handler_ids = itertools.count()
+# Обработчики в процессе (ожидают ответа или выполняются): id -> (имя, время начала)
+_active_handlers: Dict[int, Tuple[str, float]] = {}
+# Недавно завершившиеся обработчики: (имя, время окончания)
+_finished_handlers: deque = deque(maxlen=50)
+# Синхронные шаги обработчиков дольше порога: (имя, длительность, время окончания)
+_slow_steps: deque = deque(maxlen=50)
+
+
+def install_event_loop_policy():
+    """Включает uvloop, если он разрешён в настройках и установлен"""
+    if not USE_UVLOOP:
+        return
+
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("USE_UVLOOP=1, но uvloop не установлен — используется стандартный event loop")
+        return
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Используется uvloop")
+
+
+@types.coroutine
+def _run_timed(coro, on_step: Callable[[float], None]):
+    """
+    Выполняет корутину, замеряя каждый её синхронный шаг (участок между await)
+
+    Пока идёт шаг, event loop не может переключиться на другие задачи,
+    поэтому долгий шаг и есть причина задержки.
+    """
+    send, value = coro.send, None
+    while True:
+        started = time.perf_counter()
+        try:
+            yielded = send(value)
+        except StopIteration as stop:
+            on_step(time.perf_counter() - started)
+            return stop.value
+        except BaseException:
+            on_step(time.perf_counter() - started)
+            raise
+        on_step(time.perf_counter() - started)
+
+        try:
+            value = yield yielded
+            send = coro.send
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            send, value = coro.throw, e
+
+
+class HandlerTrackingMiddleware(BaseMiddleware):
+    """Отмечает обработчики в процессе и их долгие синхронные шаги для отчётов о задержках event loop"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        loop = asyncio.get_running_loop()
+        handler_id = next(_handler_ids)
+        _active_handlers[handler_id] = (name, loop.time())
+
+        def on_step(duration: float):
+            if duration >= LOOP_LAG_THRESHOLD:
+                _slow_steps.append((name, duration, loop.time()))
+
+        try:
+            return await _run_timed(handler(event, data), on_step)
+        finally:
+            del _active_handlers[handler_id]
+            _finished_handlers.append((name, loop.time()))
+
+
+def _describe_handlers(since: float) -> str:
+    """
+    Описывает обработчики за окно замера, начиная с момента since
+
+    Обработчики с долгими синхронными шагами точно блокировали event loop.
+    Остальные обработчики в процессе могли просто ждать ответа AI или БД.
+    """
+    blocking = [f"{name} ({duration * 1000:.0f} мс)" for name, duration, ended in _slow_steps if ended >= since]
+    in_flight = [name for name, _ in _active_handlers.values()]
+    in_flight += [f"{name} (завершён)" for name, finished in _finished_handlers if finished >= since]
+
+    parts = []
+    if blocking:
+        parts.append(f"блокировали: {', '.join(blocking)}")
+    parts.append(
+        "обработчики в процессе (ожидают или выполняются): "
+        + (", ".join(in_flight) if in_flight else "нет")
+    )
+    if not blocking:
+        parts.append("долгих шагов обработчиков нет (возможно, фоновые задачи)")
+    return "; ".join(parts)
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+    """
+    Периодически измеряет задержку планирования event loop
+
+    Args:
+        interval: Интервал между замерами в секундах
+        threshold: Задержка, начиная с которой пишется предупреждение в лог
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started - interval, 0.0)
+        metrics.observe_histogram("loop_lag", lag, LOOP_LAG_BUCKETS)
+
+        if lag > threshold:
+            metrics.inc("loop_lag.slow")
+            logger.warning(
+                f"Задержка event loop {lag * 1000:.0f} мс; {_describe_handlers(started)}"
+            )
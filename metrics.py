@@ -0,0 +1,85 @@
+"""
+Модуль для сбора метрик бота
+Хранит счётчики и замеры времени в памяти процесса и периодически пишет их в лог
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 600  # Интервал записи метрик в лог, сек
+
+_counters: Dict[str, float] = defaultdict(float)
+_timings: Dict[str, Dict[str, float]] = {}
+_histograms: Dict[str, Dict[str, int]] = {}
+
+
+def inc(name: str, value: float = 1):
+    """Увеличивает счётчик"""
+    _counters[name] += value
+
+
+def observe(name: str, seconds: float):
+    """Записывает замер времени"""
+    timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+    timing["count"] += 1
+    timing["total"] += seconds
+    timing["max"] = max(timing["max"], seconds)
+
+
+def observe_histogram(name: str, value: float, buckets: Sequence[float]):
+    """Добавляет значение в гистограмму с заданными границами корзин"""
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = {f"<={bound:g}": 0 for bound in buckets}
+        histogram[f">{buckets[-1]:g}"] = 0
+        _histograms[name] = histogram
+    
+    for bound in buckets:
+        if value <= bound:
+            histogram[f"<={bound:g}"] += 1
+            return
+    histogram[f">{buckets[-1]:g}"] += 1
+
+
+def get_counter(name: str) -> float:
+    """Возвращает значение счётчика"""
+    return _counters.get(name, 0)
+
+
+def get_average(name: str) -> Optional[float]:
+    """Возвращает среднее время по замеру или None, если замеров не было"""
+    timing = _timings.get(name)
+    if not timing or not timing["count"]:
+        return None
+    return timing["total"] / timing["count"]
+
+
+def snapshot() -> Dict:
+    """Возвращает копию всех метрик"""
+    return {
+        "counters": dict(_counters),
+        "timings": {name: dict(timing) for name, timing in _timings.items()},
+        "histograms": {name: dict(histogram) for name, histogram in _histograms.items()},
+    }
+
+
+def format_metrics() -> str:
+    """Форматирует метрики для вывода в лог"""
+    lines = [f"{name}={value:g}" for name, value in sorted(_counters.items())]
+    for name, timing in sorted(_timings.items()):
+        avg = timing["total"] / timing["count"] if timing["count"] else 0.0
+        lines.append(f"{name}: n={timing['count']} avg={avg:.3f}s max={timing['max']:.3f}s")
+    for name, histogram in sorted(_histograms.items()):
+        buckets = " ".join(f"{bucket}:{count}" for bucket, count in histogram.items() if count)
+        lines.append(f"{name}: {buckets}")
+    return "; ".join(lines) if lines else "нет данных"
+
+
+async def report_periodically(interval: int = REPORT_INTERVAL):
+    """Периодически пишет метрики в лог"""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Метрики: {format_metrics()}")
@@ -0,0 +1,111 @@
+"""
+Модуль для учёта настроения
+Записывает оценки /mood и реакции /now и строит по агрегатам статистику
+и краткую сводку для контекста AI
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from database import (
+    MOOD_EVENT_MOOD, MOOD_EVENT_EMOTION, EMOTION_COLUMNS,
+    add_mood_event, get_mood_daily, get_mood_weekly, get_week_key
+)
+
+# Добавлять ли сводку настроения за 7 дней в контекст AI
+MOOD_TREND_IN_CONTEXT = os.getenv("MOOD_TREND_IN_CONTEXT", "1") == "1"
+
+# Баллы настроения по шкале 1-10 для кнопок /mood
+MOOD_VALUES = {"mood_good": 8, "mood_ok": 5, "mood_bad": 2}
+
+# Коды эмоций для кнопок /now (см. EMOTION_COLUMNS)
+EMOTION_CODES = {"now_anxious": 1, "now_lonely": 2, "now_angry": 3, "now_love": 4}
+
+EMOTION_LABELS = {
+    "anxious": "тревожно",
+    "lonely": "одиноко",
+    "angry": "злюсь",
+    "love": "хочу услышать о любви",
+}
+
+
+async def record_mood(chat_id: int, callback_data: str, event_time: datetime):
+    """Сохраняет оценку настроения из /mood"""
+    value = MOOD_VALUES.get(callback_data)
+    if value is not None:
+        await add_mood_event(chat_id, MOOD_EVENT_MOOD, value, event_time)
+
+
+async def record_emotion(chat_id: int, callback_data: str, event_time: datetime):
+    """Сохраняет реакцию из /now"""
+    code = EMOTION_CODES.get(callback_data)
+    if code is not None:
+        await add_mood_event(chat_id, MOOD_EVENT_EMOTION, code, event_time)
+
+
+def _sum_rollups(rollups: List[Dict]) -> Dict:
+    """Складывает несколько агрегатов в один"""
+    total = {"mood_sum": 0, "mood_count": 0, **{column: 0 for column in EMOTION_COLUMNS.values()}}
+    for rollup in rollups:
+        for key in total:
+            total[key] += rollup[key]
+    return total
+
+
+def _format_mood(rollup: Optional[Dict]) -> str:
+    """Форматирует средний балл настроения"""
+    if not rollup or not rollup["mood_count"]:
+        return "нет отметок"
+    return f"{rollup['mood_sum'] / rollup['mood_count']:.1f}/10 (отметок: {rollup['mood_count']})"
+
+
+async def _get_last_days(chat_id: int, now: datetime, days: int = 7) -> Dict:
+    """Суммирует дневные агрегаты за последние N дней"""
+    period = [(now - timedelta(days=i)).date() for i in range(days)]
+    daily = await get_mood_daily(chat_id, period)
+    return _sum_rollups(list(daily.values()))
+
+
+async def get_trend_summary(chat_id: int, now: datetime) -> Optional[str]:
+    """
+    Возвращает краткую сводку настроения за 7 дней для контекста AI
+
+    Returns:
+        Строка сводки или None, если отметок за 7 дней нет
+    """
+    week = await _get_last_days(chat_id, now)
+    parts = []
+    if week["mood_count"]:
+        parts.append(f"среднее настроение {week['mood_sum'] / week['mood_count']:.0f}/10 (отметок: {week['mood_count']})")
+    parts += [
+        f"«{EMOTION_LABELS[column]}» — {week[column]}"
+        for column in EMOTION_COLUMNS.values()
+        if week[column]
+    ]
+    if not parts:
+        return None
+    return "Сводка настроения клиентки за 7 дней: " + ", ".join(parts)
+
+
+async def render_mood_stats(chat_id: int, now: datetime) -> str:
+    """Формирует текст статистики настроения для /moodstats"""
+    today = now.date()
+    this_week = get_week_key(today)
+    last_week = get_week_key(today - timedelta(days=7))
+
+    daily = await get_mood_daily(chat_id, [today])
+    weekly = await get_mood_weekly(chat_id, [this_week, last_week])
+    seven_days = await _get_last_days(chat_id, now)
+
+    emotions = "\n".join(
+        f"• {EMOTION_LABELS[column]} — {seven_days[column]}"
+        for column in EMOTION_COLUMNS.values()
+    )
+    return (
+        "📊 Твоё настроение\n\n"
+        f"Сегодня: {_format_mood(daily.get(today.isoformat()))}\n"
+        f"За 7 дней: {_format_mood(seven_days)}\n"
+        f"Эта неделя: {_format_mood(weekly.get(this_week))}\n"
+        f"Прошлая неделя: {_format_mood(weekly.get(last_week))}\n\n"
+        f"Реакции /now за 7 дней:\n{emotions}"
+    )
@@ -0,0 +1,324 @@
+"""
+Модуль многопроцессного режима работы бота
+Главный процесс получает обновления от Telegram и распределяет их
+по воркерам по хешу chat_id. Каждый воркер — отдельный процесс со своим
+event loop, соединениями с БД и кешами; порядок сообщений внутри чата сохраняется.
+"""
+import asyncio
+import logging
+import signal
+import multiprocessing
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types.update import UpdateTypeLookupError
+from aiogram.types import Update
+
+import metrics
+from loop_monitor import install_event_loop_policy, monitor_loop_lag
+
+logger = logging.getLogger(__name__)
+
+WORKER_CHECK_INTERVAL = 1  # Как часто проверять, что воркеры живы, сек
+
+# Фабрика воркера: (номер воркера, количество воркеров) -> (бот, диспетчер)
+WorkerFactory = Callable[[int, int], Tuple[Bot, Dispatcher]]
+
+
+def get_update_chat_id(update: Update) -> int:
+    """
+    Определяет chat_id, к которому относится обновление
+
+    Args:
+        update: Обновление Telegram
+
+    Returns:
+        ID чата (или пользователя, если чата нет), 0 если определить не удалось
+    """
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return 0
+
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        # CallbackQuery: чат берём из сообщения с кнопками
+        chat = getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+
+    user = getattr(event, "from_user", None)
+    return user.id if user else 0
+
+
+def shard_for(chat_id: int, workers: int) -> int:
+    """Возвращает номер воркера, которому принадлежит чат"""
+    return chat_id % workers
+
+
+def serialize_update(update: Update) -> str:
+    """Сериализует обновление для передачи воркеру"""
+    return update.model_dump_json(exclude_unset=True, by_alias=True)
+
+
+def stop_on_sigterm(task: asyncio.Task):
+    """Обрабатывает SIGTERM (остановку сервиса) как Ctrl+C: отменяет задачу, чтобы сработала штатная остановка"""
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    except (NotImplementedError, AttributeError):
+        pass  # Windows
+
+
+class ChatUpdateRunner:
+    """
+    Обрабатывает обновления задачами: разные чаты параллельно,
+    обновления одного чата — строго по очереди
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, on_done: Callable[[int], Awaitable[Any]]):
+        """
+        Args:
+            bot: Экземпляр бота
+            dp: Диспетчер с обработчиками
+            on_done: Вызывается с update_id после окончания обработки (в том числе с ошибкой)
+        """
+        self.bot = bot
+        self.dp = dp
+        self.on_done = on_done
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def run(self, update: Update):
+        """Обрабатывает обновление и дожидается окончания обработки"""
+        lock = self._chat_locks.setdefault(get_update_chat_id(update), asyncio.Lock())
+        async with lock:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+            finally:
+                await self.on_done(update.update_id)
+
+    def submit(self, update: Update) -> asyncio.Task:
+        """Запускает обработку обновления, не дожидаясь её окончания"""
+        task = asyncio.create_task(self.run(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def drain(self):
+        """Дожидается обработки всех запущенных обновлений"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def _worker_entry(
+    index: int,
+    workers: int,
+    queue: multiprocessing.Queue,
+    done_queue,
+    create_worker: WorkerFactory
+):
+    """Точка входа процесса-воркера"""
+    # Воркер останавливает главный процесс, дождавшись обработки очереди,
+    # поэтому сигналы остановки здесь игнорируются
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    install_event_loop_policy()
+    asyncio.run(_worker_main(index, workers, queue, done_queue, create_worker))
+
+
+async def _worker_main(
+    index: int,
+    workers: int,
+    queue: multiprocessing.Queue,
+    done_queue,
+    create_worker: WorkerFactory
+):
+    """Цикл обработки обновлений в воркере"""
+    # Фабрика передаётся по ссылке на функцию модуля, который уже загружен в процессе
+    # при запуске через spawn, поэтому модуль бота не импортируется повторно
+    bot, dp = create_worker(index, workers)
+    loop = asyncio.get_running_loop()
+    pid = multiprocessing.current_process().pid
+
+    async def report_done(update_id: int):
+        done_queue.put(("done", pid, update_id))
+
+    runner = ChatUpdateRunner(bot, dp, on_done=report_done)
+
+    def take():
+        # Сообщаем главному процессу, что обновление забрано из очереди, сразу в том же потоке:
+        # если воркер упадёт, главный процесс будет знать, какие обновления не обработаны
+        item = queue.get()
+        if item is not None:
+            done_queue.put(("taken", pid, item[0]))
+        return item
+
+    asyncio.create_task(metrics.report_periodically())
+    asyncio.create_task(monitor_loop_lag())
+
+    logger.info(f"Воркер {index} запущен")
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, take)
+            if item is None:
+                break
+            runner.submit(Update.model_validate_json(item[1], context={"bot": bot}))
+
+        # Дожидаемся обработки всего, что уже получено
+        await runner.drain()
+    finally:
+        await bot.session.close()
+        logger.info(f"Воркер {index} остановлен")
+
+
+def _start_worker(
+    ctx,
+    index: int,
+    workers: int,
+    queue: multiprocessing.Queue,
+    done_queue,
+    create_worker: WorkerFactory
+):
+    """Запускает процесс-воркер"""
+    process = ctx.Process(
+        target=_worker_entry,
+        args=(index, workers, queue, done_queue, create_worker),
+        name=f"bot-worker-{index}",
+        daemon=True
+    )
+    process.start()
+    return process
+
+
+async def run_supervisor(
+    bot: Bot,
+    workers: int,
+    create_worker: WorkerFactory,
+    allowed_updates: Optional[List[str]] = None
+):
+    """
+    Запускает воркеры и распределяет между ними обновления
+
+    Обновление отмечается обработанным во входящих, только когда воркер сообщил
+    об окончании обработки. Если воркер упал, обновления, которые он успел забрать
+    из очереди, остаются необработанными во входящих и обрабатываются при следующем
+    запуске; остальные переданные ему обновления достаются перезапущенному воркеру.
+    При остановке главный процесс дожидается, пока воркеры обработают свои очереди.
+
+    Args:
+        bot: Экземпляр бота для получения обновлений
+        workers: Количество процессов-воркеров
+        create_worker: Фабрика бота и диспетчера воркера (функция уровня модуля)
+        allowed_updates: Типы обновлений, которые нужно получать
+    """
+    # Импорт внутри функции: модуль приёма обновлений сам использует get_update_chat_id
+    from catchup import mark_processed, run_catchup, run_heartbeat, run_polling
+
+    ctx = multiprocessing.get_context("spawn")
+    loop = asyncio.get_running_loop()
+    queues = [ctx.Queue() for _ in range(workers)]
+    # SimpleQueue пишет сообщение сразу при put, поэтому отчёт воркера не теряется при его падении
+    done_queue = ctx.SimpleQueue()
+    processes = [
+        _start_worker(ctx, i, workers, queues[i], done_queue, create_worker)
+        for i in range(workers)
+    ]
+    logger.info(f"Запущено воркеров: {workers}")
+
+    stop_on_sigterm(asyncio.current_task())
+
+    assigned: Dict[int, Tuple[int, str]] = {}  # update_id -> (номер воркера, JSON) для необработанных
+    taken: Dict[int, int] = {}  # update_id -> pid воркера, который забрал обновление из очереди
+    reported: Set[int] = set()  # pid упавших воркеров, о которых уже сообщено
+    waiters: Dict[int, asyncio.Future] = {}
+
+    def route(update: Update):
+        index = shard_for(get_update_chat_id(update), workers)
+        raw = serialize_update(update)
+        assigned[update.update_id] = (index, raw)
+        queues[index].put((update.update_id, raw))
+
+    def fail(update_id: int, pid: int):
+        assigned.pop(update_id, None)
+        logger.error(
+            f"Обработка обновления {update_id} прервана падением воркера (pid {pid}), "
+            f"оно будет обработано при следующем запуске"
+        )
+        waiter = waiters.pop(update_id, None)
+        if waiter and not waiter.done():
+            waiter.set_exception(RuntimeError(f"воркер (pid {pid}) упал"))
+
+    async def finish(update_id: int):
+        assigned.pop(update_id, None)
+        waiter = waiters.pop(update_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+        await mark_processed([update_id])
+
+    def restart_worker(index: int, pid: int):
+        # Обновления, которые воркер забрал, но не обработал, считаем прерванными
+        for update_id in [uid for uid, taken_by in taken.items() if taken_by == pid]:
+            del taken[update_id]
+            fail(update_id, pid)
+        # Упавший процесс мог оставить старую очередь заблокированной, поэтому
+        # новый воркер получает новую очередь с ещё не забранными обновлениями
+        queues[index] = ctx.Queue()
+        for update_id, (assigned_to, raw) in assigned.items():
+            if assigned_to == index:
+                queues[index].put((update_id, raw))
+        processes[index] = _start_worker(ctx, index, workers, queues[index], done_queue, create_worker)
+
+    async def read_done():
+        while True:
+            message = await loop.run_in_executor(None, done_queue.get)
+            if message is None:
+                return
+            kind, pid, value = message
+            if kind == "taken":
+                taken[value] = pid
+            elif kind == "done":
+                taken.pop(value, None)
+                await finish(value)
+            else:
+                # Отметка о падении идёт в очереди после всех сообщений упавшего воркера
+                restart_worker(value, pid)
+
+    async def watch_workers():
+        # Проверка в отдельной задаче: догрузка ждёт обработки и не должна зависнуть из-за упавшего воркера
+        while True:
+            for i, process in enumerate(processes):
+                if process.is_alive() or process.pid in reported:
+                    continue
+                logger.error(f"Воркер {i} завершился (код {process.exitcode}), перезапуск")
+                reported.add(process.pid)
+                done_queue.put(("dead", process.pid, i))
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+
+    async def dispatch(update: Update):
+        # При догрузке ждём окончания обработки, чтобы работало ограничение параллельности
+        waiter = waiters[update.update_id] = loop.create_future()
+        route(update)
+        await waiter
+
+    reader = asyncio.create_task(read_done())
+    watcher = asyncio.create_task(watch_workers())
+    try:
+        offset = await run_catchup(bot, dispatch, allowed_updates)
+        asyncio.create_task(run_heartbeat())
+        await run_polling(bot, route, allowed_updates, offset)
+    finally:
+        logger.info("Остановка: ожидание обработки очередей воркеров")
+        watcher.cancel()
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        done_queue.put(None)
+        await reader
+        await bot.session.close()
+        logger.info("Все воркеры остановлены")